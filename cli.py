@@ -82,7 +82,7 @@ def parse_args():
             "--index-path", 
             type=str, 
             default="./index",
-            help="Path to store index"
+            help="Folder in which the document indexes are stored"
         )
         p.add_argument(
             "--cpu", 
@@ -94,6 +94,29 @@ def parse_args():
             action="store_true",
             help="Use low memory mode"
         )
+        p.add_argument(
+            "--quant",
+            type=str,
+            choices=["none", "int8", "nf4"],
+            default=None,
+            help="Quantization of the VLM weights (nf4 in low memory mode if not set)"
+        )
+        p.add_argument(
+            "--compile",
+            action="store_true",
+            help="Compile the MLPs of the VLM decoder with torch.compile (slower startup, speedup not benchmarked)"
+        )
+        p.add_argument(
+            "--speculative",
+            action="store_true",
+            help="Speed up answer generation with speculative decoding using a draft model"
+        )
+        p.add_argument(
+            "--draft-model",
+            type=str,
+            default="Qwen/Qwen2-0.5B-Instruct",
+            help="Draft model for speculative decoding"
+        )
     
     args = parser.parse_args()
     
@@ -118,30 +141,45 @@ def main():
         vlm_model=args.vlm_model,
         index_path=args.index_path,
         use_gpu=not args.cpu,
-        low_memory=args.low_memory
+        low_memory=args.low_memory,
+        quant=args.quant,
+        # Each command runs in its own process, so a warmed cache would be thrown away
+        warm_kv_pages=0,
+        compile_vlm=args.compile,
+        draft_model=args.draft_model if args.speculative else None
     )
     
-    if args.command == "index":
-        # Index documents
-        rag_system.index_documents(
-            folder_path=args.folder,
-            file_paths=args.files,
-            index_name=args.index_name,
-            overwrite=args.overwrite
-        )
-        print("Indexing complete!")
-        
-    elif args.command == "ask":
-        # Answer a question
-        print(f"Question: {args.question}")
-        print("Thinking...")
-        answer = rag_system.answer_question(
-            question=args.question,
-            top_k=args.top_k,
-            max_tokens=args.max_tokens
-        )
-        print("\nAnswer:")
-        print(f"{answer}")
+    try:
+        if args.command == "index":
+            # Index documents
+            rag_system.index_documents(
+                folder_path=args.folder,
+                file_paths=args.files,
+                index_name=args.index_name,
+                overwrite=args.overwrite
+            )
+            print("Indexing complete!")
+            
+        elif args.command == "ask":
+            # Answer a question
+            print(f"Question: {args.question}")
+            print("Thinking...")
+            answer = rag_system.answer_question(
+                question=args.question,
+                top_k=args.top_k,
+                max_tokens=args.max_tokens,
+                stream=True
+            )
+            print("\nAnswer:")
+            
+            # Print the answer as it is generated
+            for chunk in answer:
+                sys.stdout.write(chunk)
+                sys.stdout.flush()
+            print()
+    finally:
+        # Do not wait on exit for page conversions nobody will use
+        rag_system.close()
 
 
 if __name__ == "__main__":
@@ -3,11 +3,13 @@
 Script to create a sample PDF document with text and images for testing the RAG system.
 """
 
-from fpdf import FPDF
 import os
+import sys
 
 # Create a PDF with text and an image
 def create_sample_pdf(output_path="sample.pdf"):
+    from fpdf import FPDF
+    
     pdf = FPDF()
     pdf.add_page()
     
@@ -25,21 +27,33 @@ def create_sample_pdf(output_path="sample.pdf"):
     
     # Create a simple image
     try:
+        import numpy as np
         from PIL import Image, ImageDraw, ImageFont
         
-        # Create a new image with white background
-        img = Image.new("RGB", (400, 200), "white")
-        draw = ImageDraw.Draw(img)
+        # Create a white canvas (rows are y, columns are x)
+        canvas = np.full((200, 400, 3), 255, dtype=np.uint8)
         
         # Draw a rectangle
-        draw.rectangle([(50, 50), (350, 150)], outline="black")
+        canvas[50, 50:351] = 0
+        canvas[150, 50:351] = 0
+        canvas[50:151, 50] = 0
+        canvas[50:151, 350] = 0
+        
+        # Add a bar chart, filling all bars with a single mask
+        bar_left = np.array([75, 125, 175, 225, 275])
+        bar_top = np.array([130, 110, 90, 70, 130])
+        bar_width, bar_bottom = 25, 150
         
-        # Add a bar chart
-        draw.rectangle([(75, 130), (100, 150)], fill="blue")
-        draw.rectangle([(125, 110), (150, 150)], fill="blue")
-        draw.rectangle([(175, 90), (200, 150)], fill="blue")
-        draw.rectangle([(225, 70), (250, 150)], fill="blue")
-        draw.rectangle([(275, 130), (300, 150)], fill="blue")
+        y = np.arange(200)[None, :, None]
+        x = np.arange(400)[None, None, :]
+        bars = (
+            (x >= bar_left[:, None, None]) & (x <= bar_left[:, None, None] + bar_width)
+            & (y >= bar_top[:, None, None]) & (y <= bar_bottom)
+        ).any(axis=0)
+        canvas[bars] = (0, 0, 255)
+        
+        img = Image.fromarray(canvas)
+        draw = ImageDraw.Draw(img)
         
         # Add labels
         try:
@@ -47,27 +61,17 @@ def create_sample_pdf(output_path="sample.pdf"):
         except IOError:
             font = ImageFont.load_default()
         
-        draw.text((75, 155), "A", fill="black", font=font)
-        draw.text((125, 155), "B", fill="black", font=font)
-        draw.text((175, 155), "C", fill="black", font=font)
-        draw.text((225, 155), "D", fill="black", font=font)
-        draw.text((275, 155), "E", fill="black", font=font)
+        for left, label in zip(bar_left, "ABCDE"):
+            draw.text((int(left), 155), label, fill="black", font=font)
         
         # Add title
         draw.text((150, 50), "Figure 1: Sample Chart", fill="black", font=font)
         
-        # Save the image
-        img_path = "temp_image.png"
-        img.save(img_path)
-        
-        # Add the image to PDF
-        pdf.image(img_path, x=10, y=100, w=180)
-        
-        # Remove the temporary image
-        os.remove(img_path)
+        # Add the image to PDF (fpdf2 takes PIL images directly)
+        pdf.image(img, x=10, y=100, w=180)
         
     except ImportError:
-        pdf.cell(190, 10, "Could not create image. PIL library required.", 0, 1)
+        pdf.cell(190, 10, "Could not create image. PIL and NumPy libraries required.", 0, 1)
     
     # Add more text after the image
     pdf.ln(110)
@@ -115,13 +119,21 @@ if __name__ == "__main__":
         import pip
         pip.main(["install", "pillow"])
     
-    # Check if FPDF is installed, if not try to install it
+    # Check if fpdf2 is installed, if not try to install it
     try:
         import fpdf
     except ImportError:
-        print("FPDF not found. Attempting to install...")
+        print("fpdf2 not found. Attempting to install...")
         import pip
-        pip.main(["install", "fpdf"])
+        pip.main(["install", "fpdf2"])
+        import fpdf
+    
+    # The legacy PyFPDF package (version 1.x) is imported under the same name but cannot
+    # take PIL images. Both install into the same fpdf/ folder, so it has to be removed first
+    if int(getattr(fpdf, "FPDF_VERSION", "0").split(".")[0]) < 2:
+        print(f"Found PyFPDF {getattr(fpdf, 'FPDF_VERSION', '')}, but this script requires fpdf2. Replace it with:")
+        print("pip uninstall fpdf && pip install fpdf2")
+        sys.exit(1)
     
     # Create sample directory if needed
     os.makedirs("sample_pdfs", exist_ok=True)
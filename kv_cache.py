@@ -0,0 +1,263 @@
+"""
+Key/value cache for the retrieved page images fed to the Vision-Language Model.
+"""
+
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import torch
+
+
+# A retrieved page is identified by its (doc_id, page_num) pair
+PageKey = Tuple[int, int]
+
+# Per-layer (key, value) tensors, as returned by DynamicCache.to_legacy_cache()
+LegacyCache = Tuple[Tuple[torch.Tensor, torch.Tensor], ...]
+
+
+def cache_nbytes(cache: LegacyCache) -> int:
+    """
+    Compute the memory footprint of a key/value cache.
+
+    Args:
+        cache: Per-layer (key, value) tensors.
+
+    Returns:
+        The total number of bytes held by the tensors.
+    """
+    return sum(t.numel() * t.element_size() for layer in cache for t in layer)
+
+
+def concat_caches(caches: List[LegacyCache]) -> LegacyCache:
+    """
+    Concatenate key/value caches of consecutive token segments.
+
+    Args:
+        caches: Per-layer (key, value) tensors of each segment, in sequence order.
+
+    Returns:
+        The per-layer (key, value) tensors of the whole sequence.
+    """
+    return tuple(
+        (
+            torch.cat([layers[0] for layers in segment], dim=-2),
+            torch.cat([layers[1] for layers in segment], dim=-2)
+        )
+        for segment in zip(*caches)
+    )
+
+
+def shift_positions(cache: LegacyCache, delta: int, inv_freq: torch.Tensor) -> LegacyCache:
+    """
+    Move cached keys by delta rotary positions.
+
+    Keys are stored with their rotary embedding applied, and rotations compose, so rotating
+    by delta gives the keys the tokens would have had delta positions further. This holds
+    for Qwen2-VL's multimodal rotary embedding as long as the temporal, height and width
+    positions all move by the same delta. Values carry no positional information.
+
+    Args:
+        cache: Per-layer (key, value) tensors.
+        delta: Number of positions to move by.
+        inv_freq: The rotary inverse frequencies, of size head_dim // 2.
+
+    Returns:
+        The per-layer (key, value) tensors with shifted keys.
+    """
+    if delta == 0:
+        return cache
+
+    angles = torch.cat([inv_freq, inv_freq]) * delta
+    cos, sin = angles.cos(), angles.sin()
+
+    shifted = []
+    for k, v in cache:
+        k_float = k.float()
+        k1, k2 = k_float.chunk(2, dim=-1)
+        rotated = k_float * cos + torch.cat([-k2, k1], dim=-1) * sin
+        shifted.append((rotated.to(k.dtype), v))
+
+    return tuple(shifted)
+
+
+class PageKVCache:
+    """
+    An LRU cache of VLM key/value tensors for individual page images.
+
+    Each page is prefilled on its own after the system prompt, without attending to the
+    other retrieved pages, so its key/values can be reused wherever it appears in a later
+    prompt once shifted to its position there (see shift_positions()).
+    Entries evicted from the GPU are spilled to pinned CPU memory, which holds far more
+    pages than VRAM, and are copied back asynchronously when a prompt needs them again.
+    """
+
+    def __init__(
+        self,
+        device: str,
+        max_gpu_bytes: int,
+        max_cpu_bytes: int
+    ):
+        """
+        Initialize the cache.
+
+        Args:
+            device: The device the VLM runs on.
+            max_gpu_bytes: Maximum number of bytes of key/values kept on the device.
+            max_cpu_bytes: Maximum number of bytes of key/values spilled to CPU memory.
+        """
+        self.device = device
+        self.max_gpu_bytes = max_gpu_bytes
+        self.max_cpu_bytes = max_cpu_bytes if device == "cuda" else 0
+
+        # page -> per-layer key/values
+        self._gpu = OrderedDict()
+        self._cpu = OrderedDict()
+        self._gpu_bytes = 0
+        self._cpu_bytes = 0
+
+        # Side stream for CPU-to-GPU promotions, so transfers overlap with other work
+        self._h2d_stream = torch.cuda.Stream() if device == "cuda" else None
+
+    def __len__(self) -> int:
+        return len(self._gpu) + len(self._cpu)
+
+    def __contains__(self, page: PageKey) -> bool:
+        return page in self._gpu or page in self._cpu
+
+    @property
+    def gpu_bytes(self) -> int:
+        """Number of bytes of key/values kept on the device."""
+        return self._gpu_bytes
+
+    @property
+    def cpu_bytes(self) -> int:
+        """Number of bytes of key/values spilled to CPU memory."""
+        return self._cpu_bytes
+
+    def prefetch(self, pages: List[PageKey]) -> None:
+        """
+        Start moving the key/values of pages from CPU to GPU memory.
+
+        The copies run on a side stream, so they overlap with whatever the caller does
+        before the next lookup().
+
+        Args:
+            pages: The pages of the upcoming prompt.
+        """
+        for page in pages:
+            if page in self._cpu:
+                self._promote(page)
+
+    def lookup(self, page: PageKey) -> Optional[LegacyCache]:
+        """
+        Get the cached key/values of a page.
+
+        Args:
+            page: The page to look up.
+
+        Returns:
+            The per-layer key/values of the page, or None on a miss.
+        """
+        if page in self._cpu:
+            self._promote(page)
+        if page not in self._gpu:
+            return None
+
+        self._gpu.move_to_end(page)
+
+        # Make sure pending host-to-device copies have landed before the tensors are used
+        if self._h2d_stream is not None:
+            torch.cuda.current_stream().wait_stream(self._h2d_stream)
+
+        return self._gpu[page]
+
+    def put(self, page: PageKey, cache: LegacyCache) -> None:
+        """
+        Store the key/values of a page.
+
+        Args:
+            page: The page the key/values belong to.
+            cache: The per-layer key/values of the page tokens only.
+        """
+        self._discard(page)
+
+        nbytes = cache_nbytes(cache)
+        if nbytes > self.max_gpu_bytes:
+            return
+
+        self._gpu[page] = cache
+        self._gpu_bytes += nbytes
+        self._evict()
+
+    def clear(self) -> None:
+        """Drop all cached key/values."""
+        self._gpu.clear()
+        self._cpu.clear()
+        self._gpu_bytes = 0
+        self._cpu_bytes = 0
+
+    def _discard(self, page: PageKey) -> None:
+        if page in self._gpu:
+            self._gpu_bytes -= cache_nbytes(self._gpu.pop(page))
+        if page in self._cpu:
+            self._cpu_bytes -= cache_nbytes(self._cpu.pop(page))
+
+    def _promote(self, page: PageKey) -> None:
+        entry = self._cpu.pop(page)
+        nbytes = cache_nbytes(entry)
+        self._cpu_bytes -= nbytes
+
+        # Allocate on the compute stream, then copy on the side stream once it catches up
+        promoted = tuple(
+            (torch.empty_like(k, device=self.device), torch.empty_like(v, device=self.device))
+            for k, v in entry
+        )
+        self._h2d_stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self._h2d_stream):
+            for (k_gpu, v_gpu), (k_cpu, v_cpu) in zip(promoted, entry):
+                k_gpu.copy_(k_cpu, non_blocking=True)
+                v_gpu.copy_(v_cpu, non_blocking=True)
+
+                # The entry may be dropped before any lookup waits on the side stream, so
+                # keep the allocator from reusing its memory while the copy is in flight
+                k_gpu.record_stream(self._h2d_stream)
+                v_gpu.record_stream(self._h2d_stream)
+
+        self._gpu[page] = promoted
+        self._gpu_bytes += nbytes
+        self._evict()
+
+    def _spill(self, entry: LegacyCache) -> LegacyCache:
+        # The entry may itself still be arriving from an earlier promotion
+        if self._h2d_stream is not None:
+            torch.cuda.current_stream().wait_stream(self._h2d_stream)
+
+        spilled = tuple(
+            (
+                torch.empty(k.shape, dtype=k.dtype, pin_memory=True),
+                torch.empty(v.shape, dtype=v.dtype, pin_memory=True)
+            )
+            for k, v in entry
+        )
+        for (k_cpu, v_cpu), (k_gpu, v_gpu) in zip(spilled, entry):
+            k_cpu.copy_(k_gpu, non_blocking=True)
+            v_cpu.copy_(v_gpu, non_blocking=True)
+
+        return spilled
+
+    def _evict(self) -> None:
+        # Spill least recently used entries to pinned CPU memory
+        while self._gpu_bytes > self.max_gpu_bytes:
+            page, entry = self._gpu.popitem(last=False)
+            nbytes = cache_nbytes(entry)
+            self._gpu_bytes -= nbytes
+
+            if nbytes > self.max_cpu_bytes:
+                continue
+
+            self._cpu[page] = self._spill(entry)
+            self._cpu_bytes += nbytes
+
+        while self._cpu_bytes > self.max_cpu_bytes:
+            _, entry = self._cpu.popitem(last=False)
+            self._cpu_bytes -= cache_nbytes(entry)
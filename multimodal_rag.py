@@ -1,11 +1,125 @@
 import os
+import threading
 import torch
-from typing import List, Union, Dict, Any, Optional
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterator, List, Tuple, Union, Dict, Any, Optional
 from pathlib import Path
-from pdf2image import convert_from_path
+from pdf2image import convert_from_path, pdfinfo_from_path
 from byaldi import RAGMultiModalModel
-from transformers import Qwen2VLForConditionalGeneration, Qwen2VLProcessor
+from transformers import (
+    BitsAndBytesConfig,
+    DynamicCache,
+    Qwen2ForCausalLM,
+    Qwen2VLForConditionalGeneration,
+    Qwen2VLProcessor,
+    TextIteratorStreamer
+)
+from transformers.utils import is_flash_attn_2_available
 from qwen_vl_utils import process_vision_info
+from kv_cache import LegacyCache, PageKVCache, concat_caches, shift_positions
+from page_index import PooledIVFIndex
+
+
+# Stands in for the question when rendering the chat template around it
+_QUESTION_PLACEHOLDER = "<|question|>"
+
+# Number of pages whose preprocessed pixels are kept in CPU memory
+_MAX_CACHED_PIXELS = 32
+
+
+def _convert_page(pdf_path: str, page_num: int):
+    """
+    Convert a single PDF page to an image. Runs in a worker thread.
+    
+    Args:
+        pdf_path: Path to the PDF document.
+        page_num: The 1-indexed page number.
+        
+    Returns:
+        The image of the page.
+    """
+    return convert_from_path(pdf_path, first_page=page_num, last_page=page_num)[0]
+
+
+@torch.compile(dynamic=True)
+def _decoder_mlp(
+    hidden_states: torch.Tensor,
+    gate_weight: torch.Tensor,
+    up_weight: torch.Tensor,
+    down_weight: torch.Tensor
+) -> torch.Tensor:
+    """
+    The SwiGLU MLP of a Qwen2-VL decoder layer, compiled once for all layers.
+    
+    Weights are passed as tensors rather than modules, so dynamo guards on neither
+    the module nor the key/value cache and every layer and decode step reuses one graph.
+    
+    Args:
+        hidden_states: The input of the MLP.
+        gate_weight: The weight of the gate projection.
+        up_weight: The weight of the up projection.
+        down_weight: The weight of the down projection.
+        
+    Returns:
+        The output of the MLP.
+    """
+    gate = torch.nn.functional.linear(hidden_states, gate_weight)
+    up = torch.nn.functional.linear(hidden_states, up_weight)
+    return torch.nn.functional.linear(torch.nn.functional.silu(gate) * up, down_weight)
+
+
+def _kmeans(points: torch.Tensor, n_clusters: int, n_iter: int = 20) -> torch.Tensor:
+    """
+    Cluster points with k-means.
+    
+    Args:
+        points: The points to cluster, of shape (n_points, dim).
+        n_clusters: Number of clusters.
+        n_iter: Number of refinement iterations.
+        
+    Returns:
+        The cluster centroids, of shape (n_clusters, dim).
+    """
+    generator = torch.Generator().manual_seed(0)
+    centroids = points[torch.randperm(len(points), generator=generator)[:n_clusters]].clone()
+    
+    for _ in range(n_iter):
+        assignments = torch.cdist(points, centroids).argmin(dim=1)
+        for c in range(len(centroids)):
+            members = points[assignments == c]
+            if len(members) > 0:
+                centroids[c] = members.mean(dim=0)
+    
+    return centroids
+
+
+class _TextOnlyDraft(Qwen2ForCausalLM):
+    """
+    A text-only draft model for speculative decoding of answers about page images.
+    
+    generate() receives the VLM prompt, with thousands of image tokens per page that
+    mean nothing to a text model. They are removed before drafting and put back in the
+    returned sequences, so the draft reads the system prompt, the question and the answer
+    so far, and its key/value cache only grows with those.
+    """
+    
+    # Token ids of the page images, set once the VLM processor is loaded
+    vision_token_ids: Optional[torch.Tensor] = None
+    
+    def generate(self, input_ids: torch.Tensor, past_key_values: Optional[DynamicCache] = None, **kwargs):
+        text_ids = input_ids[:, ~torch.isin(input_ids[0], self.vision_token_ids)]
+        
+        # The cache is cropped by the caller using the length with images; drop the
+        # rejected draft tokens here instead
+        if past_key_values is not None:
+            past_key_values.crop(text_ids.shape[1] - 1)
+        
+        kwargs["attention_mask"] = torch.ones_like(text_ids)
+        output = super().generate(input_ids=text_ids, past_key_values=past_key_values, **kwargs)
+        
+        output.sequences = torch.cat([input_ids, output.sequences[:, text_ids.shape[1]:]], dim=1)
+        return output
 
 
 class RAGSystem:
@@ -19,7 +133,15 @@ class RAGSystem:
         vlm_model: str = "Qwen/Qwen2-VL-7B-Instruct",
         index_path: str = "./index",
         use_gpu: bool = True,
-        low_memory: bool = False
+        low_memory: bool = False,
+        quant: Optional[str] = None,
+        kv_cache_gb: float = 4.0,
+        kv_cache_cpu_gb: float = 16.0,
+        warm_kv_pages: int = 16,
+        compile_vlm: bool = False,
+        ann_threshold: int = 10000,
+        draft_model: Optional[str] = None,
+        num_draft_tokens: int = 5
     ):
         """
         Initialize the RAG system.
@@ -27,19 +149,46 @@ class RAGSystem:
         Args:
             colpali_model: The ColPali model to use for document retrieval.
             vlm_model: The Vision-Language Model to use for question answering.
-            index_path: Path to store the document index.
+            index_path: Folder in which the document indexes are stored.
             use_gpu: Whether to use GPU for inference.
             low_memory: Whether to use low memory mode (slower but uses less VRAM).
+            quant: Quantization of the VLM weights: "none", "int8" or "nf4".
+                Defaults to "nf4" in low memory mode on GPU and "none" otherwise.
+            kv_cache_gb: GPU memory budget in GB for cached page key/values.
+            kv_cache_cpu_gb: CPU memory budget in GB for page key/values evicted from the GPU.
+            warm_kv_pages: Number of representative pages to prefill in the background after
+                indexing, so first questions hit the key/value cache. Only applies on GPU,
+                where a prefill is cheap enough. 0 disables it.
+            compile_vlm: Whether to compile the MLPs of the VLM decoder with torch.compile.
+                Only applies on GPU with unquantized weights outside low memory mode. Compiling
+                takes a while and its speedup has not been benchmarked yet, so it is off
+                by default.
+            ann_threshold: Number of indexed pages, at least 2, from which retrieval goes
+                through an approximate IVF-PQ index instead of scoring every page.
+            draft_model: A small text model sharing the VLM's tokenizer, such as
+                "Qwen/Qwen2-0.5B-Instruct", to speed up decoding with speculative decoding.
+                The draft does not see the pages, so the speedup depends on how much of the
+                answer it can guess from the question alone. None disables it.
+            num_draft_tokens: Number of tokens the draft model proposes per VLM step.
         """
         self.colpali_model = colpali_model
         self.vlm_model = vlm_model
         self.index_path = index_path
         self.use_gpu = use_gpu
         self.low_memory = low_memory
+        self.quant = quant
+        self.warm_kv_pages = warm_kv_pages
+        self.compile_vlm = compile_vlm
+        self.ann_threshold = ann_threshold
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        
+        if ann_threshold < 2:
+            raise ValueError(f"ann_threshold must be at least 2 pages, got {ann_threshold}.")
         
         # Load the document retrieval model
         print(f"Loading document retrieval model: {colpali_model}")
-        self.retrieval_model = RAGMultiModalModel.from_pretrained(colpali_model)
+        self.retrieval_model = RAGMultiModalModel.from_pretrained(colpali_model, index_root=index_path)
         
         # Set the device
         self.device = "cuda" if use_gpu and torch.cuda.is_available() else "cpu"
@@ -56,19 +205,80 @@ class RAGSystem:
         else:
             dtype = torch.float32
         
+        # Quantize the weights with bitsandbytes, which requires a GPU
+        if quant is None:
+            quant = "nf4" if low_memory and self.device == "cuda" else "none"
+        
+        if quant == "none":
+            quant_config = None
+        elif self.device != "cuda":
+            raise ValueError(f"Quantization '{quant}' requires a GPU.")
+        elif quant == "int8":
+            quant_config = BitsAndBytesConfig(load_in_8bit=True)
+        elif quant == "nf4":
+            quant_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_compute_dtype=dtype,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_use_double_quant=True
+            )
+        else:
+            raise ValueError(f"Unknown quantization: {quant}. Use 'none', 'int8' or 'nf4'.")
+        
+        # Flash-Attention 2 never materializes the attention matrix, so it also saves memory
+        # in low memory mode. It needs an Ampere or newer GPU with half-precision weights.
+        attn_implementation = "sdpa"
+        if self.device == "cuda" and torch.cuda.get_device_capability()[0] >= 8:
+            if is_flash_attn_2_available():
+                attn_implementation = "flash_attention_2"
+            else:
+                print("flash-attn not installed, falling back to SDPA attention")
+        
         # Load model with appropriate settings
         self.vlm = Qwen2VLForConditionalGeneration.from_pretrained(
             vlm_model,
             torch_dtype=dtype,
-            attn_implementation="flash_attention_2" if not low_memory else None,
-            device_map=self.device if not low_memory else None,
+            attn_implementation=attn_implementation,
+            device_map={"": self.device},
+            quantization_config=quant_config,
             low_cpu_mem_usage=True
         )
         
-        if low_memory:
-            self.vlm = self.vlm.to(self.device)
-        
         self.vlm.eval()
+        self.vlm.config.use_cache = True
+        
+        # Fuse the activation of the decoder MLPs into their projections. Only the MLPs are
+        # compiled: anything that touches the key/value cache makes dynamo guard on the
+        # cache's token count and recompile on every decode step until it gives up
+        language_model = getattr(self.vlm.model, "language_model", self.vlm.model)
+        if (
+            compile_vlm and self.device == "cuda" and not low_memory and quant_config is None
+            and language_model.config.hidden_act == "silu"
+        ):
+            for layer in language_model.layers:
+                mlp = layer.mlp
+                mlp.forward = lambda x, mlp=mlp: _decoder_mlp(
+                    x, mlp.gate_proj.weight, mlp.up_proj.weight, mlp.down_proj.weight
+                )
+        
+        # Load the draft model for speculative decoding. The VLM checks every proposed token,
+        # so greedy answers are unchanged. The draft reads the prompt text but not the page images
+        self.draft = None
+        if draft_model is not None:
+            print(f"Loading draft model: {draft_model}")
+            self.draft = _TextOnlyDraft.from_pretrained(
+                draft_model,
+                torch_dtype=dtype,
+                attn_implementation=attn_implementation,
+                device_map={"": self.device},
+                low_cpu_mem_usage=True
+            )
+            self.draft.eval()
+            
+            # Both vocabularies are padded past the shared tokenizer, to different sizes.
+            # Matching them lets generate() compare token ids directly.
+            self.draft.resize_token_embeddings(self.vlm.config.vocab_size)
+            self.draft.generation_config.num_assistant_tokens = num_draft_tokens
         
         # Load the processor
         min_pixels = 224 * 224  # Minimum image size
@@ -79,10 +289,62 @@ class RAGSystem:
             max_pixels=max_pixels
         )
         
-        # Document cache for efficient retrieval
-        self.doc_images = {}
+        self.vision_start_token_id = self.processor.tokenizer.convert_tokens_to_ids("<|vision_start|>")
+        self.vision_end_token_id = self.processor.tokenizer.convert_tokens_to_ids("<|vision_end|>")
+        self.image_token_id = self.processor.tokenizer.convert_tokens_to_ids("<|image_pad|>")
+        
+        if self.draft is not None:
+            self.draft.vision_token_ids = torch.tensor(
+                [self.vision_start_token_id, self.image_token_id, self.vision_end_token_id],
+                device=self.device
+            )
+        
+        # Rotary inverse frequencies, to move cached page keys to their position in a prompt
+        head_dim = self.vlm.config.hidden_size // self.vlm.config.num_attention_heads
+        self._inv_freq = 1.0 / (self.vlm.config.rope_theta ** (
+            torch.arange(0, head_dim, 2, dtype=torch.float32, device=self.device) / head_dim
+        ))
+        
+        # Preprocessed pixels of recently used pages in CPU memory, keyed by (doc_id, page_num),
+        # so repeated retrievals skip PDF conversion and image preprocessing. Pixels are dropped
+        # once the page's key/values are cached, but its grid size is kept to lay out prompts
+        self.page_pixels: OrderedDict = OrderedDict()
+        self.page_grids: Dict[tuple, torch.Tensor] = {}
+        self.doc_num_pages: Dict[int, int] = {}
         self.index_name = None
         
+        # Approximate page index, only built for collections of at least ann_threshold pages
+        self.page_index = None
+        
+        # Worker threads rasterizing PDF pages in parallel, and the pages being converted.
+        # Threads are enough since pdf2image runs pdftoppm in a subprocess, outside the GIL
+        self._pdf_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+        self._pending_images: Dict[tuple, Future] = {}
+        self._images_lock = threading.Lock()
+        
+        # Chat template around the question, rendered and tokenized once per number of page images
+        self._rendered_templates: Dict[int, Tuple[str, str]] = {}
+        self._tokenized_templates: Dict[int, Tuple[torch.Tensor, torch.Tensor]] = {}
+        
+        # Key/value cache for retrieved pages, so repeated pages skip the VLM prefill.
+        # Every page is prefilled after the same system prompt, whose key/values are kept too
+        self._system_ids = None
+        self._system_kv = None
+        self.kv_cache = PageKVCache(
+            device=self.device,
+            max_gpu_bytes=int(kv_cache_gb * 1024**3),
+            max_cpu_bytes=int(kv_cache_cpu_gb * 1024**3)
+        )
+        
+        # Serializes VLM work between questions and the background cache warmer, which
+        # stops once the index it was started for is replaced. A plain lock, since a
+        # streamed answer releases it from the generation thread
+        self._vlm_lock = threading.Lock()
+        self._index_version = 0
+        
+        # Set by close() to stop the cache warmer without waiting for the VLM lock
+        self._closed = threading.Event()
+        
     def index_documents(
         self, 
         folder_path: Optional[str] = None, 
@@ -122,63 +384,460 @@ class RAGSystem:
                 overwrite=overwrite
             )
         else:
-            # Create a temporary folder for indexing if individual files are provided
-            temp_folder = os.path.join(self.index_path, "temp_index")
-            os.makedirs(temp_folder, exist_ok=True)
-            
-            # Copy files to the temporary folder
-            import shutil
             for file_path in file_paths:
                 if not os.path.exists(file_path):
                     raise FileNotFoundError(f"File not found: {file_path}")
-                
-                dest_path = os.path.join(temp_folder, os.path.basename(file_path))
-                shutil.copy2(file_path, dest_path)
             
+            # Index the files where they are: the first one creates the index and
+            # the others are added to it, so nothing is copied to a temporary folder
             print(f"Indexing {len(file_paths)} documents")
             self.retrieval_model.index(
-                input_path=temp_folder,
+                input_path=file_paths[0],
                 index_name=index_name,
                 store_collection_with_index=True,
                 overwrite=overwrite
             )
             
-            # Clean up temporary folder
-            shutil.rmtree(temp_folder)
+            if len(file_paths) > 1:
+                self.retrieval_model.add_to_index(
+                    file_paths[1:],
+                    store_collection_with_index=True
+                )
         
         print(f"Indexing complete. Index name: {index_name}")
+        
+        # Document IDs refer to the new index from now on
+        with self._vlm_lock:
+            self._index_version += 1
+            self.kv_cache.clear()
+            
+            with self._images_lock:
+                for future in self._pending_images.values():
+                    future.cancel()
+                self._pending_images.clear()
+                self.page_pixels.clear()
+                self.page_grids.clear()
+                self.doc_num_pages.clear()
+        
+        self._build_page_index()
+        
+        if self.warm_kv_pages > 0 and self.device == "cuda":
+            self._warm_kv_cache(self.warm_kv_pages)
     
-    def _get_document_images(self, doc_id: int) -> List:
+    def close(self) -> None:
+        """
+        Stop the background cache warmer and the PDF conversion threads, dropping
+        conversions that have not started.
+        
+        Without this, the interpreter waits for every pending conversion on exit.
         """
-        Get the images for a document.
+        # The warmer stops before its next page. The VLM lock is not taken, since a
+        # streamed answer holds it until generation ends
+        self._closed.set()
+        
+        self._pdf_pool.shutdown(wait=False, cancel_futures=True)
+    
+    def _build_page_index(self) -> None:
+        """
+        Build the approximate page index if the collection is large enough.
+        """
+        colpali = self.retrieval_model.model
+        self.page_index = None
+        
+        if len(colpali.indexed_embeddings) < self.ann_threshold:
+            return
+        
+        print(f"Building approximate index over {len(colpali.indexed_embeddings)} pages")
+        self.page_index = PooledIVFIndex(
+            colpali.indexed_embeddings,
+            [
+                (colpali.embed_id_to_doc_id[embed_id]["doc_id"], colpali.embed_id_to_doc_id[embed_id]["page_id"])
+                for embed_id in range(len(colpali.indexed_embeddings))
+            ]
+        )
+    
+    def _search(self, question: str, k: int) -> List:
+        """
+        Search for the pages most relevant to a question.
         
         Args:
-            doc_id: The document ID.
+            question: The question to search for.
+            k: Number of pages to retrieve.
             
         Returns:
-            A list of images for the document.
+            The search results, each with "doc_id" and "page_num".
         """
-        if doc_id in self.doc_images:
-            return self.doc_images[doc_id]
+        if self.page_index is None:
+            return self.retrieval_model.search(question, k=k)
+        
+        query_embedding = self.retrieval_model.model.encode_query(question)[0]
+        return self.page_index.search(query_embedding, k)
+    
+    def _warm_kv_cache(self, n_clusters: int) -> None:
+        """
+        Prefill the key/values of representative pages in a background thread.
+        
+        Page embeddings are mean-pooled and clustered with k-means; the page nearest to
+        each centroid is prefilled, so questions about any part of the collection are
+        likely to find some of their pages already cached.
+        
+        Args:
+            n_clusters: Number of clusters, and so at most the number of pages to prefill.
+        """
+        colpali = self.retrieval_model.model
+        if not colpali.indexed_embeddings:
+            return
+        
+        points = torch.stack([embedding.float().mean(dim=0) for embedding in colpali.indexed_embeddings])
+        points = torch.nn.functional.normalize(points, dim=-1)
         
-        # Get the original document path
+        centroids = _kmeans(points, min(n_clusters, len(points)))
+        embed_ids = torch.cdist(centroids, points).argmin(dim=1).unique().tolist()
+        
+        pages = [
+            (colpali.embed_id_to_doc_id[embed_id]["doc_id"], colpali.embed_id_to_doc_id[embed_id]["page_id"])
+            for embed_id in embed_ids
+        ]
+        
+        # Only the chosen pages are converted, ahead of their prefill
+        self._prefetch_page_images(pages)
+        
+        threading.Thread(
+            target=self._warm_pages,
+            args=(pages, self._index_version),
+            daemon=True
+        ).start()
+    
+    def _warm_pages(self, pages: List[tuple], index_version: int) -> None:
+        """
+        Prefill the key/values of pages, one at a time so questions can interleave.
+        
+        Args:
+            pages: The (doc_id, page_num) pairs to prefill.
+            index_version: The index the pages belong to.
+        """
+        for doc_id, page_num in pages:
+            if self._closed.is_set():
+                return
+            
+            with self._vlm_lock:
+                if self._closed.is_set() or self._index_version != index_version:
+                    return
+                
+                # A page that fails to convert or prefill only loses its head start
+                try:
+                    if self._get_page_grid(doc_id, page_num) is not None:
+                        self._prefill_kv_for_page(doc_id, page_num)
+                except Exception as e:
+                    # Conversions are cancelled on close
+                    if self._closed.is_set():
+                        return
+                    print(f"Warning: Could not prefill page {page_num} of document {doc_id}: {e}")
+    
+    def _get_pdf_path(self, doc_id: int) -> str:
+        """
+        Get the path of a document.
+        
+        Args:
+            doc_id: The document ID.
+            
+        Returns:
+            The path of the PDF file of the document.
+        """
         doc_info = self.retrieval_model.get_document_path(doc_id)
         
         if doc_info is None:
             raise ValueError(f"Document with ID {doc_id} not found.")
         
-        # Convert PDF to images
-        images = convert_from_path(doc_info["path"])
-        self.doc_images[doc_id] = images
+        return doc_info["path"]
+    
+    def _get_num_pages(self, doc_id: int) -> int:
+        """
+        Get the number of pages of a document.
+        
+        pdfinfo runs outside _images_lock so it never holds up the other users of the lock;
+        only reading and storing the count happen under it.
+        
+        Args:
+            doc_id: The document ID.
+            
+        Returns:
+            The number of pages of the document.
+        """
+        with self._images_lock:
+            num_pages = self.doc_num_pages.get(doc_id)
+        
+        if num_pages is None:
+            index_version = self._index_version
+            num_pages = pdfinfo_from_path(self._get_pdf_path(doc_id))["Pages"]
+            
+            # Don't store the count if the document IDs were reassigned in the meantime
+            with self._images_lock:
+                if self._index_version == index_version:
+                    self.doc_num_pages[doc_id] = num_pages
+        
+        return num_pages
+    
+    def _prefetch_page_images(self, pages: List[tuple]) -> None:
+        """
+        Start converting pages that are neither cached, preprocessed nor being converted.
+        
+        Args:
+            pages: The (doc_id, page_num) pairs to convert. Pages that do not exist are skipped.
+        """
+        # Look up paths and page counts before taking the lock
+        pages = [
+            (doc_id, page_num, self._get_pdf_path(doc_id))
+            for doc_id, page_num in pages
+            if 1 <= page_num <= self._get_num_pages(doc_id)
+        ]
         
-        return images
+        with self._images_lock:
+            for doc_id, page_num, pdf_path in pages:
+                page = (doc_id, page_num)
+                if page in self.kv_cache or page in self.page_pixels or page in self._pending_images:
+                    continue
+                self._pending_images[page] = self._pdf_pool.submit(_convert_page, pdf_path, page_num)
+    
+    def _get_page_pixels(self, doc_id: int, page_num: int) -> Optional[Dict[str, torch.Tensor]]:
+        """
+        Get the preprocessed pixels of a page, converting only that page if needed.
+        
+        Args:
+            doc_id: The document ID.
+            page_num: The 1-indexed page number.
+            
+        Returns:
+            The "pixel_values" and "image_grid_thw" tensors of the page on the VLM device,
+            or None if the document has no such page.
+        """
+        page = (doc_id, page_num)
+        
+        with self._images_lock:
+            preprocessed = page in self.page_pixels
+            if preprocessed:
+                self.page_pixels.move_to_end(page)
+        
+        if not preprocessed:
+            if not 1 <= page_num <= self._get_num_pages(doc_id):
+                return None
+            pdf_path = self._get_pdf_path(doc_id)
+            
+            # Reuse a conversion started earlier if any. The conversion stays registered until
+            # the pixels are stored, so a concurrent prefetch never starts it a second time
+            with self._images_lock:
+                future = self._pending_images.get(page)
+                if future is None:
+                    future = self._pending_images[page] = self._pdf_pool.submit(_convert_page, pdf_path, page_num)
+            
+            try:
+                # Resize the page the same way process_vision_info() does for a chat template
+                image_inputs, _ = process_vision_info(
+                    [{"role": "user", "content": [{"type": "image", "image": future.result()}]}]
+                )
+                pixels = self.processor.image_processor(images=image_inputs, return_tensors="pt")
+                
+                with self._images_lock:
+                    self.page_pixels[page] = pixels["pixel_values"]
+                    self.page_grids[page] = pixels["image_grid_thw"]
+                    
+                    if len(self.page_pixels) > _MAX_CACHED_PIXELS:
+                        self.page_pixels.popitem(last=False)
+            finally:
+                with self._images_lock:
+                    self._pending_images.pop(page, None)
+        
+        return {
+            "pixel_values": self.page_pixels[page].to(self.device, dtype=self.vlm.dtype),
+            "image_grid_thw": self.page_grids[page].to(self.device)
+        }
+    
+    def _get_page_grid(self, doc_id: int, page_num: int) -> Optional[torch.Tensor]:
+        """
+        Get the image grid size of a page, preprocessing it only if it was never seen.
+        
+        Args:
+            doc_id: The document ID.
+            page_num: The 1-indexed page number.
+            
+        Returns:
+            The "image_grid_thw" tensor of the page, or None if the document has no such page.
+        """
+        if (doc_id, page_num) not in self.page_grids and self._get_page_pixels(doc_id, page_num) is None:
+            return None
+        
+        return self.page_grids[(doc_id, page_num)]
+    
+    def _render_template(self, num_images: int) -> Tuple[str, str]:
+        """
+        Render the chat template around the question for a number of page images.
+        
+        Args:
+            num_images: Number of page images before the question.
+            
+        Returns:
+            The text before the question, with one placeholder per image, and the text
+            after it, ending with the generation prompt.
+        """
+        if num_images in self._rendered_templates:
+            return self._rendered_templates[num_images]
+        
+        chat_template = [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image"} for _ in range(num_images)
+                ] + [{"type": "text", "text": _QUESTION_PLACEHOLDER}]
+            }
+        ]
+        
+        text = self.processor.apply_chat_template(
+            chat_template, 
+            tokenize=False, 
+            add_generation_prompt=True
+        )
+        
+        self._rendered_templates[num_images] = tuple(text.split(_QUESTION_PLACEHOLDER))
+        return self._rendered_templates[num_images]
+    
+    def _template_ids(self, num_images: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Tokenize the chat template around the question for a number of page images.
+        
+        The template only changes with the number of images, so it is tokenized once and
+        only the question is tokenized per query. Both ends of the question are special
+        tokens, so this gives the same ids as tokenizing the whole prompt.
+        
+        Args:
+            num_images: Number of page images before the question.
+            
+        Returns:
+            The token ids before the question, with one image token per image, and the
+            token ids after it.
+        """
+        if num_images in self._tokenized_templates:
+            return self._tokenized_templates[num_images]
+        
+        prefix, suffix = self._render_template(num_images)
+        tokenizer = self.processor.tokenizer
+        
+        self._tokenized_templates[num_images] = (
+            tokenizer(prefix, return_tensors="pt").input_ids[0],
+            tokenizer(suffix, add_special_tokens=False, return_tensors="pt").input_ids[0]
+        )
+        return self._tokenized_templates[num_images]
+    
+    def _get_system_kv(self) -> LegacyCache:
+        """
+        Get the key/values of the chat template tokens preceding the page images.
+        
+        Returns:
+            The per-layer key/values of the system prompt and user turn header.
+        """
+        if self._system_kv is not None:
+            return self._system_kv
+        
+        prefix_ids, _ = self._template_ids(1)
+        vision_start = int((prefix_ids == self.vision_start_token_id).nonzero()[0])
+        
+        self._system_ids = prefix_ids[:vision_start].unsqueeze(0).to(self.device)
+        
+        # Text-only tokens share the same position on all three rotary axes
+        num_tokens = self._system_ids.shape[1]
+        position_ids = torch.arange(num_tokens, device=self.device).view(1, 1, -1).expand(3, 1, -1)
+        
+        with torch.inference_mode():
+            outputs = self.vlm(
+                input_ids=self._system_ids,
+                position_ids=position_ids,
+                past_key_values=DynamicCache(),
+                use_cache=True,
+                return_dict=True
+            )
+        
+        self._system_kv = outputs.past_key_values.to_legacy_cache()
+        return self._system_kv
+    
+    def _prefill_kv_for_page(self, doc_id: int, page_num: int) -> LegacyCache:
+        """
+        Get the key/values of a page image, running the VLM prefill on a cache miss.
+        
+        The page is prefilled right after the system prompt, independently of any other
+        page, so the result can be placed anywhere in a prompt with shift_positions().
+        
+        Args:
+            doc_id: The document ID.
+            page_num: The 1-indexed page number.
+            
+        Returns:
+            The per-layer key/values of the page tokens, from <|vision_start|> to <|vision_end|>.
+        """
+        page = (doc_id, page_num)
+        cached = self.kv_cache.lookup(page)
+        if cached is not None:
+            return cached
+        
+        system_kv = self._get_system_kv()
+        offset = self._system_ids.shape[1]
+        
+        pixels = self._get_page_pixels(doc_id, page_num)
+        
+        num_image_tokens = int(pixels["image_grid_thw"].prod()) // self.processor.image_processor.merge_size**2
+        page_ids = torch.tensor(
+            [[self.vision_start_token_id] + [self.image_token_id] * num_image_tokens + [self.vision_end_token_id]],
+            device=self.device
+        )
+        
+        position_ids, _ = self.vlm.get_rope_index(
+            torch.cat([self._system_ids, page_ids], dim=1),
+            pixels["image_grid_thw"]
+        )
+        
+        with torch.inference_mode():
+            outputs = self.vlm(
+                input_ids=page_ids,
+                position_ids=position_ids[:, :, offset:],
+                past_key_values=DynamicCache.from_legacy_cache(system_kv),
+                pixel_values=pixels["pixel_values"],
+                image_grid_thw=pixels["image_grid_thw"],
+                cache_position=torch.arange(offset, offset + page_ids.shape[1], device=self.device),
+                use_cache=True,
+                return_dict=True
+            )
+        
+        # Keep only the page tokens, as standalone tensors so the system prompt is not held twice
+        page_kv = tuple(
+            (k[..., offset:, :].clone(), v[..., offset:, :].clone())
+            for k, v in outputs.past_key_values.to_legacy_cache()
+        )
+        self.kv_cache.put(page, page_kv)
+        
+        # The pixels are only needed again once the key/values are evicted
+        with self._images_lock:
+            if page in self.kv_cache:
+                self.page_pixels.pop(page, None)
+        
+        return page_kv
+    
+    def _set_rope_deltas(self, rope_deltas: torch.Tensor) -> None:
+        """
+        Set the rotary position offset the VLM uses for tokens after a cached prefix.
+        
+        Args:
+            rope_deltas: The offset returned by get_rope_index() for the full prompt.
+        """
+        # Depending on the transformers version, the offset lives on the wrapper or the inner model
+        for module in (self.vlm, getattr(self.vlm, "model", None)):
+            if module is not None and hasattr(module, "rope_deltas"):
+                module.rope_deltas = rope_deltas
     
     def answer_question(
         self, 
         question: str, 
         top_k: int = 3, 
-        max_tokens: int = 500
-    ) -> str:
+        max_tokens: int = 500,
+        stream: bool = False
+    ) -> Union[str, Iterator[str]]:
         """
         Answer a question based on the indexed documents.
         
@@ -186,89 +845,176 @@ class RAGSystem:
             question: The question to answer.
             top_k: Number of relevant document pages to retrieve.
             max_tokens: Maximum number of tokens in the answer.
+            stream: Whether to return an iterator over the answer text as it is generated.
+                Generation runs in a background thread, so the caller can already retrieve
+                pages for its next question meanwhile.
             
         Returns:
-            The answer to the question.
+            The answer to the question, or an iterator over its chunks if stream is set.
         """
         if self.index_name is None:
             raise ValueError("No documents have been indexed. Call index_documents() first.")
         
         # Search for relevant document pages
         print(f"Searching for relevant pages for question: {question}")
-        results = self.retrieval_model.search(question, k=top_k)
+        results = self._search(question, top_k)
         
         if not results:
-            return "No relevant documents found. Please try a different question or index some documents first."
+            answer = iter(["No relevant documents found. Please try a different question or index some documents first."])
+        else:
+            # Start converting every retrieved page at once, so the worker threads
+            # rasterize them while this thread waits for the VLM (e.g. a previous streamed
+            # answer) instead of one page after the other
+            self._prefetch_page_images([(result["doc_id"], result["page_num"]) for result in results])
+            
+            # Released by _generate_answer() once the answer is complete
+            self._vlm_lock.acquire()
+            try:
+                answer = self._generate_answer(question, results, max_tokens)
+            except BaseException:
+                self._vlm_lock.release()
+                raise
+        
+        return answer if stream else "".join(answer)
+    
+    def _generate_answer(self, question: str, results: List, max_tokens: int) -> Iterator[str]:
+        """
+        Start answering a question from the pages found by the retrieval model.
+        
+        Must be called with the VLM lock held. The lock is released once generation
+        finishes, which happens in a background thread.
+        
+        Args:
+            question: The question to answer.
+            results: The search results of the retrieval model.
+            max_tokens: Maximum number of tokens in the answer.
+            
+        Returns:
+            An iterator over the chunks of the answer as they are generated.
+        """
+        # Start bringing back key/values of these pages spilled to CPU memory,
+        # overlapping the transfer with the page loading and preprocessing below
+        self.kv_cache.prefetch([(result["doc_id"], result["page_num"]) for result in results])
         
-        # Get the images for the retrieved pages
-        retrieved_images = []
+        # Check the retrieved pages exist, preprocessing those never seen before
+        retrieved_pages = []
         for result in results:
             doc_id = result["doc_id"]
             page_num = result["page_num"]
             
-            # Get all images for the document
-            doc_images = self._get_document_images(doc_id)
-            
             # Page numbers are 1-indexed in search results
-            image_index = page_num - 1
-            
-            if 0 <= image_index < len(doc_images):
-                retrieved_images.append(doc_images[image_index])
+            if self._get_page_grid(doc_id, page_num) is not None:
+                retrieved_pages.append((doc_id, page_num))
             else:
                 print(f"Warning: Page {page_num} not found in document {doc_id}")
         
-        if not retrieved_images:
-            return "Failed to retrieve document images. Please check your document index."
+        if not retrieved_pages:
+            self._vlm_lock.release()
+            return iter(["Failed to retrieve document images. Please check your document index."])
         
-        # Prepare the chat template
-        chat_template = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "image", "image": image} for image in retrieved_images
-                ] + [{"type": "text", "text": question}]
-            }
-        ]
+        # Prepare inputs for the VLM, with placeholders for the already preprocessed pages
+        prefix_ids, suffix_ids = self._template_ids(len(retrieved_pages))
+        question_ids = self.processor.tokenizer(
+            question, 
+            add_special_tokens=False, 
+            return_tensors="pt"
+        ).input_ids[0]
         
-        # Prepare inputs for the VLM
-        text = self.processor.apply_chat_template(
-            chat_template, 
-            tokenize=False, 
-            add_generation_prompt=True
+        image_grid_thw = torch.cat([self.page_grids[page] for page in retrieved_pages]).to(self.device)
+        
+        # Expand each image placeholder to the number of tokens of its page
+        input_ids = torch.cat([prefix_ids, question_ids, suffix_ids])
+        repeats = torch.ones_like(input_ids)
+        repeats[input_ids == self.image_token_id] = (
+            image_grid_thw.prod(dim=-1).cpu() // self.processor.image_processor.merge_size**2
         )
         
-        image_inputs, _ = process_vision_info(chat_template)
+        input_ids = input_ids.repeat_interleave(repeats).unsqueeze(0).to(self.device)
+        attention_mask = torch.ones_like(input_ids)
         
-        inputs = self.processor(
-            text=[text], 
-            images=image_inputs, 
-            padding=True, 
-            return_tensors="pt"
+        position_ids, rope_deltas = self.vlm.get_rope_index(
+            input_ids, 
+            image_grid_thw, 
+            None, 
+            attention_mask
         )
         
-        inputs = inputs.to(self.device)
-        
-        # Generate the answer
-        with torch.no_grad():
-            generated_ids = self.vlm.generate(
-                **inputs, 
-                max_new_tokens=max_tokens,
-                do_sample=False
-            )
+        # Token offset of each page image in the prompt
+        page_starts = (input_ids[0] == self.vision_start_token_id).nonzero().flatten().tolist()
         
-        # Process the output
-        generated_ids_trimmed = [
-            out_ids[len(in_ids):] 
-            for in_ids, out_ids in zip(inputs.input_ids, generated_ids)
-        ]
+        # Assemble the key/values of the prompt up to the question
+        with torch.inference_mode():
+            # Pages are prefilled independently after the system prompt (reusing cached ones),
+            # then moved to their position in this prompt. Pages do not attend to each other,
+            # which keeps the prefill linear in top_k; the question still attends to all pages.
+            segments = [self._get_system_kv()]
+            for (doc_id, page_num), start in zip(retrieved_pages, page_starts):
+                page_kv = self._prefill_kv_for_page(doc_id, page_num)
+                delta = int(position_ids[0, 0, start]) - self._system_ids.shape[1]
+                segments.append(shift_positions(page_kv, delta, self._inv_freq))
+            
+            past_key_values = DynamicCache.from_legacy_cache(concat_caches(segments))
+            
+            # Only the question tokens are left to prefill, at positions shifted by the images
+            self._set_rope_deltas(rope_deltas)
         
-        output_text = self.processor.batch_decode(
-            generated_ids_trimmed, 
+        # Generate the answer, decoding tokens as they are produced instead of waiting for the whole answer
+        streamer = TextIteratorStreamer(
+            self.processor.tokenizer, 
+            skip_prompt=True, 
             skip_special_tokens=True, 
             clean_up_tokenization_spaces=False
         )
         
-        return output_text[0]
+        generate_kwargs = dict(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=past_key_values,
+            max_new_tokens=max_tokens,
+            do_sample=False,
+            streamer=streamer,
+            assistant_model=self.draft
+        )
+        
+        errors = []
+        threading.Thread(target=self._run_generate, args=(generate_kwargs, errors), daemon=True).start()
+        
+        return self._stream_answer(streamer, errors)
+    
+    def _stream_answer(self, streamer: TextIteratorStreamer, errors: List[BaseException]) -> Iterator[str]:
+        """
+        Yield the chunks of an answer, then raise the error generation failed with, if any.
+        
+        Args:
+            streamer: The streamer of the generation thread.
+            errors: Filled by the generation thread if generation fails.
+            
+        Returns:
+            An iterator over the chunks of the answer.
+        """
+        yield from streamer
+        
+        if errors:
+            raise errors[0]
+    
+    def _run_generate(self, generate_kwargs: Dict[str, Any], errors: List[BaseException]) -> None:
+        """
+        Run VLM generation, then release the VLM lock. Runs in a background thread.
+        
+        Args:
+            generate_kwargs: Keyword arguments for generate(), including the streamer.
+            errors: Receives the exception if generation fails, to be raised to the caller.
+        """
+        try:
+            # Inference mode is thread-local, so it is entered here rather than by the caller
+            with torch.inference_mode():
+                self.vlm.generate(**generate_kwargs)
+        except BaseException as e:
+            # Hand the error over before unblocking the consumer of the streamer
+            errors.append(e)
+            generate_kwargs["streamer"].end()
+        finally:
+            self._vlm_lock.release()
 
 
 # Example usage
@@ -0,0 +1,109 @@
+"""
+Approximate nearest neighbour search over ColPali page embeddings for large collections.
+"""
+
+import math
+from typing import Dict, List, Tuple
+
+import faiss
+import numpy as np
+import torch
+
+
+def _pool(embedding: torch.Tensor) -> torch.Tensor:
+    """
+    Mean-pool a multi-vector embedding into a single unit vector.
+
+    Args:
+        embedding: The token embeddings, of shape (n_tokens, dim).
+
+    Returns:
+        The normalized mean embedding, of shape (dim,).
+    """
+    return torch.nn.functional.normalize(embedding.float().mean(dim=0), dim=-1)
+
+
+class PooledIVFIndex:
+    """
+    A Faiss IVF-PQ index over mean-pooled ColPali page embeddings.
+
+    ColPali scores pages by late interaction (MaxSim) over many token vectors, which a
+    single-vector index cannot represent exactly. The pooled IVF-PQ index only proposes
+    candidates, which are then reranked exactly by MaxSim against the page embeddings.
+    The embeddings are referenced rather than copied, so the index only adds the
+    compressed codes to the retrieval model's memory.
+    """
+
+    def __init__(
+        self,
+        page_embeddings: List[torch.Tensor],
+        pages: List[Tuple[int, int]],
+        m: int = 16,
+        nbits: int = 8,
+        nprobe: int = 16,
+        candidates_per_result: int = 10
+    ):
+        """
+        Build and train the index.
+
+        Args:
+            page_embeddings: The multi-vector embedding of each page, of shape (n_tokens, dim).
+            pages: The (doc_id, page_num) pair of each page.
+            m: Number of product quantizer sub-vectors; must divide the embedding dimension.
+            nbits: Bits per sub-vector code. Lowered for collections smaller than 2**nbits
+                pages, since training needs at least one page per code.
+            nprobe: Number of inverted lists visited per query.
+            candidates_per_result: Candidates reranked for each requested result.
+        """
+        if len(page_embeddings) < 2:
+            raise ValueError("An IVF-PQ index needs at least 2 pages.")
+
+        self.pages = pages
+        self.page_embeddings = page_embeddings
+        self.candidates_per_result = candidates_per_result
+
+        pooled = torch.stack([_pool(embedding) for embedding in page_embeddings]).numpy()
+        num_pages, dim = pooled.shape
+
+        nbits = min(nbits, int(math.log2(num_pages)))
+        nlist = max(1, int(math.sqrt(num_pages)))
+        self._quantizer = faiss.IndexFlatIP(dim)
+        self.index = faiss.IndexIVFPQ(self._quantizer, dim, nlist, m, nbits, faiss.METRIC_INNER_PRODUCT)
+
+        # Faiss recommends at least 39 training points per centroid
+        num_train = min(num_pages, 39 * max(nlist, 2**nbits))
+        train_ids = np.random.default_rng(0).choice(num_pages, size=num_train, replace=False)
+        self.index.train(pooled[train_ids])
+        self.index.add(pooled)
+        self.index.nprobe = nprobe
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def search(self, query_embedding: torch.Tensor, k: int) -> List[Dict]:
+        """
+        Find the pages most relevant to a query.
+
+        Args:
+            query_embedding: The multi-vector query embedding, of shape (n_tokens, dim).
+            k: Number of pages to return.
+
+        Returns:
+            Up to k results with "doc_id", "page_num" and "score", best first.
+        """
+        query = query_embedding.float()
+
+        _, ids = self.index.search(_pool(query).numpy()[None], k * self.candidates_per_result)
+        candidates = [int(i) for i in ids[0] if i >= 0]
+
+        # Exact late-interaction score: best matching page token for each query token
+        scores = [
+            float((query @ self.page_embeddings[i].float().T).max(dim=1).values.sum())
+            for i in candidates
+        ]
+
+        ranked = sorted(zip(scores, candidates), reverse=True)[:k]
+        return [
+            {"doc_id": self.pages[i][0], "page_num": self.pages[i][1], "score": score}
+            for score, i in ranked
+        ]
@@ -0,0 +1,142 @@
+"""
+CPU tests for the page key/value cache.
+"""
+
+import pytest
+import torch
+from transformers import Qwen2VLConfig
+from transformers.models.qwen2_vl.modeling_qwen2_vl import (
+    Qwen2VLRotaryEmbedding,
+    apply_multimodal_rotary_pos_emb
+)
+
+from kv_cache import PageKVCache, cache_nbytes, concat_caches, shift_positions
+
+
+MROPE_SECTION = [2, 3, 3]
+
+
+def _rotary_embedding() -> Qwen2VLRotaryEmbedding:
+    config = Qwen2VLConfig(
+        hidden_size=64,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        rope_scaling={"type": "mrope", "mrope_section": MROPE_SECTION}
+    )
+    return Qwen2VLRotaryEmbedding(config)
+
+
+def _rotate(keys: torch.Tensor, position_ids: torch.Tensor, rotary: Qwen2VLRotaryEmbedding) -> torch.Tensor:
+    # Keys as Qwen2-VL stores them in its cache, with the multimodal rotary embedding applied
+    cos, sin = rotary(keys, position_ids)
+    _, rotated = apply_multimodal_rotary_pos_emb(keys, keys, cos, sin, MROPE_SECTION)
+    return rotated
+
+
+def _image_position_ids(offset: int, height: int, width: int) -> torch.Tensor:
+    # Temporal, height and width positions of an image grid, as get_rope_index() lays them out
+    h = torch.arange(height).repeat_interleave(width)
+    w = torch.arange(width).repeat(height)
+    return torch.stack([torch.zeros_like(h), h, w]).view(3, 1, -1) + offset
+
+
+def _entry(num_tokens: int, num_layers: int = 2) -> tuple:
+    return tuple(
+        (torch.randn(1, 2, num_tokens, 16), torch.randn(1, 2, num_tokens, 16))
+        for _ in range(num_layers)
+    )
+
+
+@pytest.mark.parametrize("delta", [0, 1, 37, 1000])
+def test_shift_positions_matches_prefill_at_shifted_positions(delta):
+    torch.manual_seed(0)
+    rotary = _rotary_embedding()
+    position_ids = _image_position_ids(offset=5, height=4, width=6)
+
+    keys = torch.randn(1, 2, position_ids.shape[-1], 16)
+    values = torch.randn_like(keys)
+
+    cached = ((_rotate(keys, position_ids, rotary), values),)
+    shifted = shift_positions(cached, delta, rotary.inv_freq)
+
+    expected = _rotate(keys, position_ids + delta, rotary)
+    # Angles grow with the positions, so float32 rounding grows too
+    torch.testing.assert_close(shifted[0][0], expected, atol=1e-4, rtol=1e-4)
+    assert shifted[0][1] is values
+
+
+def test_shift_positions_composes():
+    torch.manual_seed(0)
+    rotary = _rotary_embedding()
+    cache = _entry(10)
+
+    twice = shift_positions(shift_positions(cache, 20, rotary.inv_freq), 30, rotary.inv_freq)
+    once = shift_positions(cache, 50, rotary.inv_freq)
+
+    for (k_twice, _), (k_once, _) in zip(twice, once):
+        torch.testing.assert_close(k_twice, k_once, atol=1e-5, rtol=1e-5)
+
+
+def test_concat_caches_joins_along_sequence():
+    first, second = _entry(3), _entry(5)
+    joined = concat_caches([first, second])
+
+    assert len(joined) == 2
+    assert joined[0][0].shape[-2] == 8
+    torch.testing.assert_close(joined[1][1][..., 3:, :], second[1][1])
+    assert cache_nbytes(joined) == cache_nbytes(first) + cache_nbytes(second)
+
+
+def test_page_kv_cache_evicts_least_recently_used():
+    entry_bytes = cache_nbytes(_entry(4))
+    cache = PageKVCache("cpu", max_gpu_bytes=2 * entry_bytes, max_cpu_bytes=0)
+
+    cache.put((0, 1), _entry(4))
+    cache.put((0, 2), _entry(4))
+    assert cache.lookup((0, 1)) is not None
+
+    # (0, 2) is now the least recently used page
+    cache.put((0, 3), _entry(4))
+    assert (0, 1) in cache and (0, 3) in cache
+    assert (0, 2) not in cache
+    assert cache.lookup((0, 2)) is None
+    assert cache.gpu_bytes == 2 * entry_bytes
+
+
+def test_page_kv_cache_accounts_replaced_and_oversized_entries():
+    entry_bytes = cache_nbytes(_entry(4))
+    cache = PageKVCache("cpu", max_gpu_bytes=3 * entry_bytes, max_cpu_bytes=0)
+
+    cache.put((0, 1), _entry(4))
+    cache.put((0, 1), _entry(4))
+    assert len(cache) == 1
+    assert cache.gpu_bytes == entry_bytes
+
+    # Larger than the whole budget: dropped, along with the previous entry for the page
+    cache.put((0, 1), _entry(16))
+    assert (0, 1) not in cache
+    assert cache.gpu_bytes == 0
+
+    cache.put((0, 2), _entry(4))
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.gpu_bytes == cache.cpu_bytes == 0
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="The CPU tier is only used with a GPU")
+def test_page_kv_cache_spills_to_cpu_and_promotes_back():
+    entry = tuple((k.cuda(), v.cuda()) for k, v in _entry(4))
+    entry_bytes = cache_nbytes(entry)
+    cache = PageKVCache("cuda", max_gpu_bytes=entry_bytes, max_cpu_bytes=entry_bytes)
+
+    cache.put((0, 1), entry)
+    cache.put((0, 2), tuple((k.clone(), v.clone()) for k, v in entry))
+    assert (0, 1) in cache and (0, 2) in cache
+    assert cache.gpu_bytes == cache.cpu_bytes == entry_bytes
+
+    # Promoting (0, 1) back spills (0, 2), the least recently used page
+    promoted = cache.lookup((0, 1))
+    assert promoted[0][0].is_cuda
+    torch.testing.assert_close(promoted[0][0], entry[0][0])
+    assert len(cache) == 2
+    assert cache.gpu_bytes == cache.cpu_bytes == entry_bytes
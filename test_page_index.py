@@ -0,0 +1,62 @@
+"""
+CPU tests for the approximate page index.
+"""
+
+import pytest
+import torch
+
+from page_index import PooledIVFIndex
+
+
+def _collection(num_pages: int, num_tokens: int = 30, dim: int = 128) -> list:
+    generator = torch.Generator().manual_seed(num_pages)
+    return [torch.randn(num_tokens, dim, generator=generator) for _ in range(num_pages)]
+
+
+def _query_for(page_embedding: torch.Tensor) -> torch.Tensor:
+    # A query whose tokens closely match some of the page tokens
+    return page_embedding[:10] + 0.01 * torch.randn(10, page_embedding.shape[1])
+
+
+def _maxsim(query: torch.Tensor, page_embedding: torch.Tensor) -> float:
+    return float((query @ page_embedding.T).max(dim=1).values.sum())
+
+
+@pytest.mark.parametrize("num_pages", [2, 3, 100, 300, 1000])
+def test_finds_matching_page(num_pages):
+    torch.manual_seed(0)
+    embeddings = _collection(num_pages)
+    index = PooledIVFIndex(embeddings, [(7, page_num) for page_num in range(1, num_pages + 1)], nprobe=64)
+
+    for i in range(0, num_pages, max(1, num_pages // 20)):
+        results = index.search(_query_for(embeddings[i]), k=1)
+        assert results[0]["doc_id"] == 7
+        assert results[0]["page_num"] == i + 1
+
+
+def test_results_are_exact_maxsim_scores_best_first():
+    torch.manual_seed(0)
+    embeddings = _collection(300)
+    index = PooledIVFIndex(embeddings, [(0, page_num) for page_num in range(1, 301)])
+
+    query = _query_for(embeddings[42])
+    results = index.search(query, k=5)
+
+    assert len(results) == 5
+    scores = [result["score"] for result in results]
+    assert scores == sorted(scores, reverse=True)
+    for result in results:
+        assert result["score"] == pytest.approx(_maxsim(query, embeddings[result["page_num"] - 1]), rel=1e-5)
+
+
+def test_reranks_from_the_given_embeddings():
+    embeddings = _collection(50)
+    index = PooledIVFIndex(embeddings, [(0, page_num) for page_num in range(1, 51)])
+
+    assert index.page_embeddings is embeddings
+    assert len(index) == 50
+
+
+def test_rejects_single_page():
+    with pytest.raises(ValueError):
+        PooledIVFIndex(_collection(1), [(0, 1)])